@@ -1,3 +1,6 @@
+import numpy as np
+
+from torch import from_numpy
 from torchvision.datasets import CocoCaptions
 from numpy.random import randint
 
@@ -20,11 +23,16 @@ def get_extract_dataloaders(data_path, image_shape=None, batch_size=1, num_worke
 	return {mode: _get_extract_dataloader(data_path / mode, image_shape, batch_size, num_workers) for mode in ('train', 'val')}
 
 def _get_extract_dataloader(data_path, image_shape=None, batch_size=1, num_workers=0):
+	import magnet as mag
+
 	from torch.utils.data.dataloader import DataLoader
 	transform = get_transform(image_shape)
 
+	# Pinned batches only help if they're copied over to the GPU.
+	pin_memory = str(mag.device).startswith('cuda')
+
 	dataset = CocoCaptions(data_path, data_path / 'captions.json', transform)
-	return DataLoader(dataset, batch_size, num_workers=num_workers)
+	return DataLoader(dataset, batch_size, num_workers=num_workers, pin_memory=pin_memory)
 
 def get_transform(image_shape=None):
 	"""
@@ -59,7 +67,7 @@ def get_training_dataloaders(data_path, caption_idx, shuffle):
 def _get_training_dataloader(data_path, caption_idx, shuffle):
 	from torch.utils.data.dataloader import DataLoader
 
-	dataset = CocoExtracted(data_path, data_path / 'captions.json', data_path / 'features.pt', caption_idx)
+	dataset = CocoExtracted(data_path, data_path / 'captions.json', data_path / 'features.npy', caption_idx)
 	return DataLoader(dataset, batch_size=1, shuffle=shuffle)
 
 class CocoExtracted(CocoCaptions):
@@ -75,13 +83,12 @@ class CocoExtracted(CocoCaptions):
 		:param root: The root path of the COCO dataset.
 		:param annFile: The path where the captions JSON file resides.
 		:param feature_file: The path where the features were extracted.
+							It's memory-mapped, so the features are only read from disk when needed.
 		:param caption_idx: The index of the captions to be used for training. The COCO dataset has 5 captions per image. While training, one of these is chosen according to
 							the value of this parameter. If negative, indices will be randomly chosen at runtime for each image.
 		"""
-		import torch
-
 		super().__init__(root, annFile)
-		self.features = torch.load(feature_file, map_location='cpu')
+		self.features = np.load(str(feature_file), mmap_mode='r')
 		self.caption_idx = caption_idx
 
 	def __getitem__(self, index):
@@ -91,7 +98,7 @@ class CocoExtracted(CocoCaptions):
 		caption = '` ' + caption
 		if caption[-1] != '.': caption += '.'
 
-		features = self.features[index]
+		features = from_numpy(self.features[index].astype(np.float32))
 		return features, caption
 
 	def _get_caption(self, index):
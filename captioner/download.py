@@ -1,5 +1,15 @@
+import os, shutil, json
+
 from pathlib import Path
-from captioner.utils import working_directory
+from zipfile import ZipFile
+from threading import Event
+from http.client import HTTPException
+from urllib.request import Request, urlopen
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from captioner.utils import get_tqdm
+
+try: import wget
+except ImportError: wget = None
 
 image_url = lambda mode: f'http://images.cocodataset.org/zips/{mode}2017.zip'
 annotations_url = 'http://images.cocodataset.org/annotations/annotations_trainval2017.zip'
@@ -17,7 +27,7 @@ def download_images(mode, path):
 		return # Why bother. Job already done
 	except: pass
 
-	_download_and_extract(image_url(mode), path, lambda: os.rename(f'{mode}2017', f'{mode}'))
+	_download_and_extract(image_url(mode), path, lambda path: os.rename(path / f'{mode}2017', path / mode))
 
 def download_captions(path):
 	"""
@@ -29,37 +39,158 @@ def download_captions(path):
 		print('Already downloaded.')
 		return # Why bother. Job already done
 
-	def extras():
-		import shutil
-
+	def extras(path):
 		for mode in ('train', 'val'):
-			os.rename(f'annotations/captions_{mode}2017.json', f'{mode}/captions.json')
-		shutil.rmtree('annotations')
+			os.rename(path / 'annotations' / f'captions_{mode}2017.json', path / mode / 'captions.json')
+		shutil.rmtree(path / 'annotations')
 
 	_download_and_extract(annotations_url, path, extras)
 
-@working_directory
 def _download_and_extract(url, path, extras=None):
-	import wget, os
-
-	from zipfile import ZipFile
-
-	filename = Path(url).name
+	# Absolute paths are used throughout instead of changing the working directory,
+	# since that is global to the process and isn't safe with the worker threads.
+	path = Path(path).resolve()
+	filename = path / Path(url).name
 
 	# Download if not yet done
-	if not Path(filename).exists():
+	if not filename.exists():
 		print('Downloading...')
-		wget.download(url)
+		_download(url, filename)
 
 	print('Extracting...')
-	ZipFile(filename).extractall() # Extract
+	_extract_zip(filename, path)
 
 	os.remove(filename) # Remove the zip file since it's no longer needed
 
-	if extras is not None: extras()
+	if extras is not None: extras(path)
+
+def _download(url, filename, num_connections=8, num_retries=5, timeout=30):
+	with urlopen(Request(url, method='HEAD'), timeout=timeout) as response:
+		size = int(response.headers.get('Content-Length', 0))
+		accepts_ranges = response.headers.get('Accept-Ranges') == 'bytes'
+		etag = response.headers.get('ETag')
+
+	if size == 0 or not accepts_ranges:
+		if wget is None: raise ImportError(f"{url} doesn't support parallel downloads and wget isn't installed. Run 'pip install wget' first.")
+		wget.download(url, str(filename)) # Fall back to a single stream
+		return
+
+	# Download to a temporary file so that an interrupted download isn't mistaken for a complete one.
+	# The number of bytes written for each range is kept alongside it, so that the download can be resumed.
+	part_filename = str(filename) + '.part'
+	state_filename = part_filename + '.json'
+
+	written = _load_download_state(state_filename, part_filename, size, etag, num_connections)
+	if written is None:
+		written = [0] * num_connections
+		with open(part_filename, 'wb') as f:
+			if hasattr(os, 'posix_fallocate'): os.posix_fallocate(f.fileno(), 0, size)
+			else: f.truncate(size)
+
+	# Each connection fetches one contiguous range of the file and writes it at its own offset.
+	bounds = [size * i // num_connections for i in range(num_connections + 1)]
+	failed = Event()
+
+	def download_range(i):
+		start, end = bounds[i], bounds[i + 1]
+
+		for attempt in range(num_retries + 1):
+			if written[i] == end - start or failed.is_set(): return
+
+			headers = {'Range': f'bytes={start + written[i]}-{end - 1}'}
+			if etag is not None: headers['If-Range'] = etag # Make sure that the file hasn't changed in between
+
+			try:
+				with urlopen(Request(url, headers=headers), timeout=timeout) as response, open(part_filename, 'r+b') as f:
+					if response.status != 206: raise RuntimeError(f'Range request for {url} was not honoured')
+
+					f.seek(start + written[i])
+					for block in iter(lambda: response.read(1 << 20), b''):
+						if failed.is_set(): return # Another range failed. No point in carrying on.
+
+						f.write(block)
+						written[i] += len(block)
+						prog_bar.update(len(block))
+			except (OSError, HTTPException):
+				if attempt == num_retries: raise
+
+		if written[i] != end - start: raise RuntimeError(f'Could not download bytes {start}-{end - 1} of {url}')
+
+	prog_bar = get_tqdm()(total=size, initial=sum(written), unit='B', unit_scale=True)
+	try:
+		with ThreadPoolExecutor(num_connections) as executor:
+			futures = [executor.submit(download_range, i) for i in range(num_connections)]
+			try:
+				for future in as_completed(futures): future.result()
+			except BaseException:
+				failed.set() # Stop the other ranges instead of waiting for them to finish
+				raise
+	finally:
+		prog_bar.close()
+		if sum(written) != size: _save_download_state(state_filename, size, etag, written)
+
+	if os.path.exists(state_filename): os.remove(state_filename)
+	os.rename(part_filename, filename)
+
+def _load_download_state(state_filename, part_filename, size, etag, num_connections):
+	# Without an ETag, there's no telling if the partial download is of the same file.
+	if etag is None or not (os.path.exists(state_filename) and os.path.exists(part_filename)): return None
+
+	with open(state_filename) as f: state = json.load(f)
+	if state['size'] != size or state['etag'] != etag or len(state['written']) != num_connections: return None
+
+	return state['written']
+
+def _save_download_state(state_filename, size, etag, written):
+	with open(state_filename, 'w') as f: json.dump({'size': size, 'etag': etag, 'written': written}, f)
+
+def _extract_zip(filename, path):
+	path = Path(path).resolve()
+	with ZipFile(filename) as zip_file: members = zip_file.infolist()
+
+	# Create the directories beforehand so that the workers don't race to make them.
+	# These are worked out from the same sanitized names that ZipFile.extract writes to.
+	files, directories = [], set()
+	for member in members:
+		target = _get_member_path(member, path)
+		if target is None: continue # Nothing to write, or it points outside the path
+
+		if member.is_dir(): directories.add(target)
+		else:
+			directories.add(target.parent)
+			files.append(member)
+
+	for directory in directories: directory.mkdir(parents=True, exist_ok=True)
+
+	# zlib releases the GIL while decompressing, so the members can be extracted in parallel threads.
+	# A ZipFile isn't safe to read from multiple threads, hence each worker opens its own.
+	num_workers = os.cpu_count() or 1
+
+	def extract(shard):
+		with ZipFile(filename) as zip_file:
+			for member in shard: zip_file.extract(member, path)
+
+	with ThreadPoolExecutor(num_workers) as executor:
+		list(executor.map(extract, [files[i::num_workers] for i in range(num_workers)]))
+
+def _get_member_path(member, path):
+	# Same as the sanitization in ZipFile.extract. Drive letters and empty, '.' and '..' parts are dropped.
+	name = member.filename.replace('/', os.path.sep)
+	if os.path.altsep: name = name.replace(os.path.altsep, os.path.sep)
+	name = os.path.splitdrive(name)[1]
+
+	parts = [part for part in name.split(os.path.sep) if part not in ('', os.path.curdir, os.path.pardir)]
+	if len(parts) == 0: return None
+
+	target = path.joinpath(*parts).resolve()
+	if target != path and path not in target.parents: return None
+
+	return target
 
 def __main():
-	from captioner.utils import DIR_DATA
+	from captioner.utils import get_data_paths
+
+	DIR_DATA, _ = get_data_paths()
 
 	for mode, name in (('val', 'Validation'), ('train', 'Training')):
 		print(f'\n{name} set:')
@@ -43,7 +43,9 @@ def __main(image, beam_size, probabilistic, image_shape, hidden_size, num_layers
 	from captioner.nlp import get_nlp
 	from captioner.extract import Extractor
 	from captioner.model import Model
-	from captioner.utils import DIR_CHECKPOINTS
+	from captioner.utils import get_data_paths
+
+	_, DIR_CHECKPOINTS = get_data_paths()
 
 	device = 'cuda:0' if mag.device == 'cuda' else mag.device
 	nlp = get_nlp('en_core_web_lg', vocab_size, DIR_CHECKPOINTS / 'vocab')
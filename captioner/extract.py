@@ -1,4 +1,15 @@
+import os
 import magnet as mag
+import numpy as np
+import torch
+import torchvision.models
+
+from types import MethodType
+from functools import partial
+from contextlib import ExitStack
+from torch.nn import AdaptiveAvgPool2d
+from torch.utils.data.dataloader import DataLoader
+from captioner.utils import get_tqdm
 
 def Extractor(architecture):
 	"""
@@ -7,8 +18,6 @@ def Extractor(architecture):
 	:param architecture: The ResNet Architecture to use for extraction. Currently supports 'resnet18', 'resnet34', 'resnet50', 'resnet101' and 'resnet152'
 	:return: The CNN extractor.
 	"""
-	import torchvision.models
-
 	architecture = getattr(torchvision.models, architecture)
 	model = architecture(pretrained=True).to(mag.device)
 	_detach_head(model)
@@ -16,18 +25,8 @@ def Extractor(architecture):
 	return model
 
 def _detach_head(model):
-	from types import MethodType
-	from torch.nn import AdaptiveAvgPool2d
-	from torch.utils.data.dataloader import DataLoader
-
 	def extractor_forward(self, x):
-		if isinstance(x, DataLoader):
-			from torch import cat
-
-			from captioner.utils import get_tqdm
-			tqdm = get_tqdm()
-
-			return cat([self(x_i.to(mag.device)) for x_i, _ in tqdm(iter(x))])
+		if isinstance(x, DataLoader): return extract(self, x)
 
 		x = self.conv1(x)
 		x = self.bn1(x)
@@ -49,20 +48,76 @@ def _detach_head(model):
 	model.avgpool = AdaptiveAvgPool2d(1)
 	model.forward = MethodType(extractor_forward, model)
 
-def __main(architecture, image_shape, extractor_batch_size, num_workers):
-	import torch
+def extract(extractor, dataloader, save_path=None):
+	"""
+	Extracts the features of all the images in a DataLoader.
+
+	:param extractor: The extractor CNN.
+	:param dataloader: DataLoader of the images.
+	:param save_path: If provided, the features are saved to this path (as a .npy file) while they're being extracted.
+	:return: The features as a (num_images, feature_size) tensor. If saved, the tensor is backed by the file.
+	"""
+	tqdm = get_tqdm()
+
+	shape = (len(dataloader.dataset), extractor.feature_size)
+
+	if save_path is not None:
+		# The features are written straight to a memory-mapped file as they are extracted.
+		# No full copy of them is ever held in memory.
+		# The file is only moved to save_path once complete, so that an interrupted extraction isn't mistaken for a finished one.
+		part_path = str(save_path) + '.part'
+		features_mmap = np.lib.format.open_memmap(part_path, mode='w+', dtype=np.float16, shape=shape)
+		features = torch.from_numpy(features_mmap)
+		pin_memory = False
+	else:
+		# The features are collected in (pinned) host memory instead of on the GPU.
+		# This keeps the GPU memory free for the extractor and lets the copies overlap with the computation.
+		pin_memory = str(mag.device).startswith('cuda')
+		features = torch.empty(*shape)
+		if pin_memory: features = features.pin_memory()
+
+	# No gradients are needed, so skip the autograd bookkeeping altogether.
+	# inference_mode is stricter than no_grad, but only available on newer versions of PyTorch.
+	inference_mode = getattr(torch, 'inference_mode', torch.no_grad)
+	autocast = _get_autocast()
+
+	i = 0
+	for x, _ in tqdm(iter(dataloader)):
+		with inference_mode(), autocast(): y = extractor(x.to(mag.device, non_blocking=True))
+		features[i:i + y.size(0)].copy_(y.to(features.dtype), non_blocking=True)
+		i += y.size(0)
+
+	if pin_memory: torch.cuda.synchronize() # Wait for the last copies to finish
+	if save_path is not None:
+		features_mmap.flush()
+		os.rename(part_path, save_path)
+
+	return features
+
+def _get_autocast():
+	# Returns a context manager factory which runs the extractor in half precision on the GPU where PyTorch supports it.
+	# The weights stay in full precision, autocast handles the casting for each op.
+	if not torch.cuda.is_available(): return ExitStack
+
+	if hasattr(torch, 'autocast'): return partial(torch.autocast, 'cuda')
+
+	try: from torch.cuda.amp import autocast
+	except ImportError: return ExitStack # Older versions of PyTorch
+
+	return autocast
 
-	from pathlib import Path
+def __main(architecture, image_shape, extractor_batch_size, num_workers):
 	from captioner.data import get_extract_dataloaders
-	from captioner.utils import DIR_DATA
+	from captioner.utils import get_data_paths
+
+	DIR_DATA, _ = get_data_paths()
 
 	dataloader = get_extract_dataloaders(DIR_DATA, image_shape, extractor_batch_size, num_workers)
 	extractor = Extractor(architecture)
 
 	for mode, name in (('val', 'Validation'), ('train', 'Training')):
 		print(f'Extracting features for {name} set.')
-		with mag.eval(extractor): features = extractor(dataloader[mode])
-		torch.save(features, DIR_DATA / mode / 'features.pt')
+		with mag.eval(extractor): extract(extractor, dataloader[mode], DIR_DATA / mode / 'features.npy')
 
 	print('Done')
 
@@ -66,7 +66,7 @@ class Model(nn.Module):
         return self.fc(x)
 
     def _generate(self, features, nlp, beam_size, max_len, probabilistic):
-        self._search.build = lambda *args: self._build(*args, nlp=nlp)
+        self._search.build_batch = lambda *args: self._build_batch(*args, nlp=nlp)
         branches = self._search(beam_size, features, max_len, probabilistic)
 
         captions, probs = [], []
@@ -84,25 +84,40 @@ class Model(nn.Module):
 
         return [(captions[i], probs[i]) for i in sort_idx]
 
-    def _build(self, content, context, nlp):
-        prev_ids = content
-        if len(prev_ids) == 0:
-            x = torch.tensor(nlp('`')[0].vector).view(1, 1, -1).to(self.device)
-            h = self._get_initial_hidden(context)
-        else:
-            h = context
-            last_idx = prev_ids[-1]
-            if last_idx == self.fc.out_features - 1:
-                x = torch.zeros(1, 1, self.rnn.input_size).to(self.device)
-            else:
-                hash_val = nlp.vocab.vectors.find(row=last_idx)[0]
-                x = torch.tensor(nlp.vocab.vectors[hash_val]).to(self.device).view(1, 1, -1)
-
-        x, context = self.rnn(x, h)
-        log_probs = F.log_softmax(self.fc(x).view(-1), dim=-1)
-        content, scores  = list(zip(*[(i, p.item()) for i, p in enumerate(log_probs)]))
-
-        return content, scores, context
+    def _build_batch(self, contents, contexts, nlp):
+        # Gather the inputs of all the branches on the host and move them to the device in one go.
+        x = np.stack([self._get_input(content, nlp) for content in contents]).astype(np.float32, copy=False)
+        x = torch.from_numpy(x).unsqueeze(1).to(self.device)
+        h = self._gather_hidden(contents, contexts)
+
+        x, h = self.rnn(x, h)
+        log_probs = F.log_softmax(self.fc(x).squeeze(1), dim=-1)
+
+        scores = log_probs.detach().cpu().numpy()
+        contents = [range(len(score)) for score in scores]
+
+        # Each branch only holds a reference to its row of the shared hidden state.
+        return contents, scores, [(h, i) for i in range(len(scores))]
+
+    def _gather_hidden(self, contents, contexts):
+        # At the first step, the contexts are the image features.
+        if contents[0] is None: return _cat_hidden([self._get_initial_hidden(context) for context in contexts])
+
+        # Every branch refers to the hidden state of the previous step.
+        # Gather the rows of the surviving branches in one go instead of copying them out one by one.
+        h = contexts[0][0]
+        idx = torch.tensor([i for _, i in contexts], device=self.device)
+
+        if isinstance(h, tuple): return tuple(h_i.index_select(1, idx) for h_i in h)
+        return h.index_select(1, idx)
+
+    def _get_input(self, last_idx, nlp):
+        if last_idx is None: return nlp('`')[0].vector
+
+        if last_idx == self.fc.out_features - 1: return np.zeros(self.rnn.input_size, dtype=np.float32)
+
+        hash_val = nlp.vocab.vectors.find(row=last_idx)[0]
+        return nlp.vocab.vectors[hash_val]
 
     def _get_initial_hidden(self, features):
         h0 = F.relu(self.fc_feat(features)).view(1, -1, self.rnn.hidden_size).transpose(0, 1).contiguous()
@@ -114,4 +129,9 @@ class Model(nn.Module):
         super().to(*args, **kwargs)
         try: self.device = next(self.parameters())[0].device
         except: pass
-        return self
\ No newline at end of file
+        return self
+
+def _cat_hidden(hiddens):
+    # Concatenates the hidden states of multiple branches along the batch dimension.
+    if isinstance(hiddens[0], tuple): return tuple(torch.cat(h, dim=1) for h in zip(*hiddens))
+    return torch.cat(hiddens, dim=1)
\ No newline at end of file
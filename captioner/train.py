@@ -77,9 +77,11 @@ def _get_loss(model, feature, caption, nlp):
 def __main(epochs, iterations, shuffle, optimizer, learning_rate, vocab_size, caption_idx, hidden_size, num_layers, rnn_type):
 	from captioner.data import get_training_dataloaders
 	from captioner.nlp import get_nlp
-	from captioner.utils import DIR_DATA, DIR_CHECKPOINTS, get_optimizer
+	from captioner.utils import get_data_paths, get_optimizer
 
-	if not (DIR_DATA / 'train' / 'features.pt').exists():
+	DIR_DATA, DIR_CHECKPOINTS = get_data_paths()
+
+	if not (DIR_DATA / 'train' / 'features.npy').exists():
 		print("Features don't seem to be extracted or cannot be found. Run extract.py once again, maybe?")
 		return
 
@@ -1,10 +1,21 @@
+import sys
+import tqdm
 import numpy as np
 
-from contextlib import contextmanager
+from heapq import nlargest
+from itertools import cycle
+from functools import lru_cache
 from collections import namedtuple
-from itertools import chain
+from collections.abc import Sequence
 
-def _get_data_paths():
+@lru_cache(maxsize=1)
+def get_data_paths():
+	"""
+	Returns the data and checkpoint directories, creating them if needed.
+	This is done on the first call rather than on import, so that merely importing this module doesn't touch the filesystem.
+
+	:return: A (DIR_DATA, DIR_CHECKPOINTS) tuple.
+	"""
 	from pathlib import Path
 
 	DIR_DATA = Path('~/.data/COCO').expanduser()
@@ -13,12 +24,12 @@ def _get_data_paths():
 	for directory in [DIR_DATA, DIR_CHECKPOINTS]: directory.mkdir(exist_ok=True, parents=True)
 	return DIR_DATA, DIR_CHECKPOINTS
 
-DIR_DATA, DIR_CHECKPOINTS = _get_data_paths()
-
 class BeamSearch:
-	Branch = namedtuple('Branch', ['content', 'score', 'context'])
+	# Each branch only stores the content of its last node and a pointer to its parent branch.
+	# The full content is traced back once the search is complete.
+	Branch = namedtuple('Branch', ['content', 'parent', 'score', 'context'])
 
-	def __init__(self, build=None):
+	def __init__(self, build=None, build_batch=None):
 		"""
 		A Beam Searcher instance.
 
@@ -27,10 +38,21 @@ class BeamSearch:
 					The definition of what these are is upto the function.
 
 					Content represents the things in a particular node.
+					The content passed is that of the last node of the branch (None at the root).
 					Context represents the features of a branch of nodes.
 					A score is the log probability of a particular node.
+		:param build_batch: A function, f(contents, contexts) which is the batched version of build.
+					It takes in a list of contents and contexts (one for each branch) and
+					returns a (contents, scores, contexts) tuple whose elements are indexed by branch.
+					If provided, all branches are expanded in a single call at each step.
+					Otherwise, build is called once for each branch.
+
+					If every branch has the same number of nodes (eg. the scores are a (num_branches, num_nodes) array),
+					a deterministic search picks the best nodes of all branches at once.
+					Otherwise, the nodes of each branch are pruned separately.
 		"""
 		self.build = build
+		self.build_batch = build_batch
 
 	def __call__(self, beam_size, context, max_len, probabilistic=0):
 		"""
@@ -45,45 +67,103 @@ class BeamSearch:
 		return self._search(beam_size, context, max_len, probabilistic)
 
 	def _search(self, beam_size, context, max_len, probabilistic):
-		branches = [self.Branch([], 0, context)]
+		branches = [self.Branch(None, None, 0, context)]
 
+		get_branches = self._get_branches
 		for _ in range(max_len):
-			branches = list(chain(*[[new_branch
-									 for new_branch in self._get_branches(branch, beam_size, probabilistic)]
-									for branch in branches]))
+			contents, scores, contexts = self._expand(branches)
+
+			score_matrix = None if probabilistic else _as_matrix(scores)
+			if score_matrix is not None:
+				branches = self._step(branches, contents, score_matrix, contexts, beam_size)
+				continue
+
+			new_branches = []
+			extend = new_branches.extend
+			for branch, expansion in zip(branches, zip(contents, scores, contexts)):
+				extend(get_branches(branch, expansion, beam_size, probabilistic))
+
+			branches = self._prune_branches(new_branches, beam_size, probabilistic)
+
+		scores = np.fromiter((branch.score for branch in branches), dtype=np.float64, count=len(branches))
+		probs = np.exp(scores - scores.max()) # Shift by the max for numerical stability
+		probs /= probs.sum()
 
-			branches = self._prune_branches(branches, beam_size, probabilistic)
+		return [self.Branch(self._trace(branch), None, float(prob), None) for branch, prob in zip(branches, probs)]
 
-		branches = [self.Branch(branch.content, np.exp(branch.score), None) for branch in branches]
+	def _step(self, branches, contents, scores, contexts, beam_size):
+		# Score the nodes of all the branches as one array and only make Branches out of the top beam_size.
+		total_scores = scores + np.array([branch.score for branch in branches])[:, None]
+		rows, cols = np.unravel_index(_top_k(total_scores.ravel(), beam_size), total_scores.shape)
 
-		return branches
+		parents = [self._detach_context(branch) for branch in branches]
+		return [self._merge(parents[r], self.Branch(contents[r][c], None, scores[r, c], contexts[r]))
+				for r, c in zip(rows.tolist(), cols.tolist())]
 
-	def _get_branches(self, branch, beam_size, probabilistic):
-		contents, scores, context = self.build(branch.content, branch.context)
-		nodes = [self.Branch([content], score, context)
+	def _expand(self, branches):
+		# Returns the (contents, scores, contexts) of all the branches, indexed by branch.
+		if self.build_batch is None: return tuple(zip(*[self.build(branch.content, branch.context) for branch in branches]))
+
+		return self.build_batch([branch.content for branch in branches], [branch.context for branch in branches])
+
+	def _get_branches(self, branch, expansion, beam_size, probabilistic):
+		contents, scores, context = expansion
+		nodes = [self.Branch(content, None, score, context)
 				 for content, score in zip(contents, scores)]
 
 		if not probabilistic: nodes = self._prune_branches(nodes, beam_size, probabilistic)
 
-		return [self._merge(branch, node) for node in nodes]
+		parent = self._detach_context(branch)
+		return [self._merge(parent, node) for node in nodes]
 
 	def _merge(self, b1, b2):
-		return self.Branch(b1.content + b2.content, b1.score + b2.score, b2.context)
+		return self.Branch(b2.content, b1, b1.score + b2.score, b2.context)
+
+	@staticmethod
+	def _detach_context(branch):
+		# Once expanded, a branch's context is no longer needed. Drop it so that it can be freed.
+		# This is done once for each parent, and the result is shared by all its children.
+		return branch._replace(context=None)
+
+	@staticmethod
+	def _trace(branch):
+		content = []
+		while branch.parent is not None:
+			content.append(branch.content)
+			branch = branch.parent
+
+		return content[::-1]
 
 	@staticmethod
 	def _prune_branches(branches, beam_size, probabilistic):
-		branches = _sort_list(branches, key=lambda branch: np.exp(branch.score), probabilistic=probabilistic)
+		if not probabilistic:
+			# Log probabilities are monotonic in the probabilities, so compare them directly.
+			# Only the top beam_size are needed, hence a bounded heap instead of a full sort.
+			return nlargest(beam_size, branches, key=lambda branch: branch.score)
+
+		branches = _sort_list(branches, key=lambda branch: branch.score)
 		return branches[:beam_size]
 
-def _sort_list(x, key, probabilistic):
-	if not probabilistic:
-		x.sort(key=key, reverse=True)
-		return x
+def _as_matrix(scores):
+	# Returns the scores of all the branches as a 2D array, or None if the branches have different numbers of nodes.
+	if isinstance(scores, np.ndarray): return scores.astype(np.float64, copy=False) if scores.ndim == 2 else None
+	if len({len(branch_scores) for branch_scores in scores}) != 1: return None
 
-	probs = np.array([key(x_i) for x_i in x])
+	return np.asarray(scores, dtype=np.float64)
+
+def _top_k(x, k):
+	# Indices of the k largest elements of x, in descending order.
+	ids = np.argpartition(x, -k)[-k:] if k < len(x) else np.arange(len(x))
+	return ids[np.argsort(-x[ids], kind='stable')]
+
+def _sort_list(x, key):
+	# Samples an ordering of x according to its probabilities.
+	# The key gives log probabilities. Normalize them in one vectorized softmax.
+	scores = np.fromiter((key(x_i) for x_i in x), dtype=np.float64, count=len(x))
+	probs = np.exp(scores - scores.max())
 	probs /= probs.sum()
 
-	ids = np.random.choice(list(range(len(x))), len(x), replace=False, p=probs)
+	ids = np.random.choice(len(x), len(x), replace=False, p=probs)
 	return [x[i] for i in ids]
 
 def launch(fn, defaults=None, default_module=None):
@@ -150,61 +230,20 @@ def loopy(gen):
 	:param gen: The generator object to loop.
 	:return: An infinite iterator.
 	"""
-	while True:
-		for x in iter(gen): yield x
-
-def working_directory(path):
-	"""
-	A context manager cum decorator which changes the working directory to the specified path.
-	If used as a decorator with no arguments, the first path in the arguments of the inner function is used.
-
-	:param path: The path to change to/the function to decorate
-	"""
-	from inspect import isfunction
-	if not isfunction(path):
-		return _working_directory_context_manager(path)
-
-	from functools import wraps
-
-	@wraps(path)
-	def new_fn(*args, **kwargs):
-		from pathlib import PosixPath
+	# Sequences and one-shot iterators are cycled over in C. Note that the latter are cached after the first pass.
+	# Anything else (eg. a DataLoader) is iterated afresh each time so that shuffling takes effect.
+	if isinstance(gen, Sequence) or hasattr(gen, '__next__'): return cycle(gen)
+	return _loop(gen)
 
-		working_path = [a for a in args if type(a) is PosixPath]
-		if len(working_path) != 0: working_path = working_path[0]
-		else:
-			working_path = [v for v in kwargs.values() if type(v) is PosixPath]
-			if len(working_path) != 0: working_path = working_path[0]
-			else: raise RuntimeError('No suitable paths found')
-
-		with _working_directory_context_manager(working_path):
-			return path(*args, **kwargs)
-
-	return new_fn
-
-@contextmanager
-def _working_directory_context_manager(path):
-	import os
-
-	# Change to working directory
-	path_cwd = os.getcwd()
-	os.chdir(path)
-
-	yield
-
-	os.chdir(path_cwd) # Change back to working directory
+def _loop(gen):
+	while True: yield from gen
 
+@lru_cache(maxsize=1)
 def get_tqdm():
 	"""
 	:return: Returns a flexible tqdm object according to the environment of execution.
 	"""
-	import tqdm
-
-	try:
-		get_ipython()
-		return getattr(tqdm, 'tqdm_notebook')
-	except:
-		return getattr(tqdm, 'tqdm')
+	return tqdm.tqdm_notebook if 'IPython' in sys.modules else tqdm.tqdm
 
 def get_optimizer(optimizer):
 	"""